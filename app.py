@@ -1,11 +1,26 @@
 import streamlit as st
 import google.generativeai as genai
+import asyncio
+import json
 import subprocess
 import tempfile
 import os
 import re
+import queue
 import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
 from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from render_worker import RenderWorker, RenderWorkerPool
 
 
 # --- Streamlit Page Configuration (MUST BE FIRST Streamlit command) ---
@@ -46,10 +61,48 @@ with st.sidebar:
 genai.configure(api_key="api_key") # Replace with your key
 MODEL_NAME = "gemini-2.0-flash-001" 
 
+@st.cache_resource
+def get_model() -> genai.GenerativeModel:
+    """Builds the Gemini model once so that it survives Streamlit script reruns."""
+    return genai.GenerativeModel(MODEL_NAME)
+
+_MODEL = get_model()
+
+# Structured output: the model returns the Scene class name alongside the code.
+# Valid scripts for 20-25 frames are ~100-400 tokens, so capping the output bounds tail
+# latency; a low temperature also makes repeat prompts produce the same (cacheable) code.
+GENERATION_CONFIG = {
+    "max_output_tokens": 600,
+    "temperature": 0.3,
+    "candidate_count": 1,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "OBJECT",
+        "properties": {
+            "scene_name": {"type": "STRING"},
+            "code": {"type": "STRING"},
+        },
+        "required": ["scene_name", "code"],
+    },
+}
+
 # Manim output quality: -ql (low), -qm (medium), -qh (high), -qk (4k)
 MANIM_QUALITY = "-ql" # Low quality for faster rendering
-
-# --- LLM Prompt (Original code - unchanged) ---
+MANIM_FPS = 15 # Caps the frame count if the LLM overshoots the short run_time budget
+# OpenGL speeds up shape-only scenes but needs a GL context, which headless hosts usually lack
+MANIM_USE_OPENGL = False
+MANIM_OUTPUT_MAX_LINES = 500 # Lines of Manim CLI output kept per stream for error reports
+RENDER_WORKERS = min(4, os.cpu_count() or 1) # Render worker processes kept alive for concurrent sessions
+
+# Generated code is cached on disk so repeat (or near-identical) prompts skip the LLM
+CACHE_DIR = Path(tempfile.gettempdir()) / "sketchmotion_cache"
+CACHE_DB_PATH = CACHE_DIR / "cache_v2.sqlite3" # Bump the version whenever the schema changes
+EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.92 # Minimum cosine similarity for a cached prompt to count as a hit
+RENDER_CACHE_MAX_ENTRIES = 64 # Rendered videos kept on disk; the least frequently used are evicted
+RENDER_CACHE_MIN_AGE_SECONDS = 3600 # Videos added or hit more recently are never evicted, as sessions may be showing them
+
+# --- LLM Prompt ---
 LLM_PROMPT_TEMPLATE = """
 You are an expert Manim programmer specializing in creating concise and precise mathematical animations.
 Your task is to generate Python code for a Manim animation based on the user's request.
@@ -57,7 +110,7 @@ Your task is to generate Python code for a Manim animation based on the user's r
 Follow these strict instructions:
 1.  The animation should be a high-quality mathematical visualization.
 2.  The generated Manim code **must** produce an animation that is very short, ideally resulting in approximately 20 to 25 frames. To achieve this, use very short `run_time` values for your `self.play()` calls (e.g., `run_time=0.25` or `run_time=0.5`). The total sum of `run_time`s for all animations in the `construct` method should not exceed 1.0 to 1.5 seconds. Avoid long `self.wait()` calls.
-3.  **Only output the Python code block.** Do NOT include any explanations, introductory text, "Here's the code:", or markdown code fences (like ```python ... ```). Just the raw Python code.
+3.  Respond with a JSON object with two fields: `scene_name`, the name of the Scene class, and `code`, the raw Python code. Do NOT include any explanations, introductory text, or markdown code fences (like ```python ... ```) in `code`.
 4.  The code must start with `from manim import *` and any other necessary imports (like `import numpy as np`).
 5.  The code must define a single Manim `Scene` class. The class name should be descriptive of the animation (e.g., `class CircleAnimation(Scene):`).
 6.  The scene must contain a `construct(self)` method where all animation logic resides.
@@ -67,113 +120,459 @@ Follow these strict instructions:
 
 User Request: {user_prompt}
 
-Generated Manim Code:
+Response:
 """
 
+# --- Code Cache ---
+
+def _prompt_key(user_query: str) -> str:
+    """Hashes a prompt after normalizing case and whitespace."""
+    normalized = " ".join(user_query.lower().split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def _open_cache_db() -> sqlite3.Connection:
+    """Opens the persistent cache database, creating it on first use."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS code_cache ("
+        "key TEXT PRIMARY KEY, prompt TEXT NOT NULL, scene_name TEXT NOT NULL, code TEXT NOT NULL, embedding BLOB)"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS render_cache (key TEXT PRIMARY KEY, hits INTEGER NOT NULL)")
+    return conn
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def _cached_code_for_key(key: str) -> tuple[str, str]:
+    """
+    Exact-match tier in front of the persistent store.
+    Raises KeyError on a miss so that misses are never memoized.
+    """
+    with closing(_open_cache_db()) as conn:
+        row = conn.execute("SELECT scene_name, code FROM code_cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        raise KeyError(key)
+    return tuple(row)
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def _embed_prompt(user_query: str) -> np.ndarray:
+    """Embeds a prompt as a unit vector for cosine-similarity lookups."""
+    result = genai.embed_content(model=EMBEDDING_MODEL, content=user_query, task_type="semantic_similarity")
+    vector = np.asarray(result["embedding"], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+@st.cache_resource
+def _get_semantic_index() -> dict:
+    """Loads every stored prompt embedding into one matrix shared by all sessions."""
+    with closing(_open_cache_db()) as conn:
+        rows = conn.execute("SELECT key, embedding FROM code_cache WHERE embedding IS NOT NULL").fetchall()
+    vectors = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows]) if rows else None
+    return {"lock": threading.Lock(), "keys": [key for key, _ in rows], "vectors": vectors}
+
+def lookup_cached_code(user_query: str) -> tuple[str, str] | None:
+    """Returns the cached (scene_name, manim_code) for this prompt (or a near-identical one), if any."""
+    try:
+        return _cached_code_for_key(_prompt_key(user_query))
+    except KeyError:
+        pass
+
+    index = _get_semantic_index()
+    with index["lock"]:
+        keys, vectors = list(index["keys"]), index["vectors"]
+    if vectors is None:
+        return None
+    try:
+        query_vector = _embed_prompt(user_query)
+    except Exception:
+        return None # The semantic tier is best-effort; fall through to the LLM
+
+    similarities = vectors @ query_vector
+    best = int(np.argmax(similarities))
+    if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    try:
+        return _cached_code_for_key(keys[best])
+    except KeyError:
+        return None
+
+def store_cached_code(user_query: str, scene_name: str, manim_code: str) -> None:
+    """Stores generated code under the prompt's hash and adds the prompt to the semantic index."""
+    key = _prompt_key(user_query)
+    try:
+        embedding = _embed_prompt(user_query)
+    except Exception:
+        embedding = None
+
+    with closing(_open_cache_db()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO code_cache (key, prompt, scene_name, code, embedding) VALUES (?, ?, ?, ?, ?)",
+            (key, user_query, scene_name, manim_code, embedding.tobytes() if embedding is not None else None),
+        )
+
+    if embedding is not None:
+        index = _get_semantic_index()
+        with index["lock"]:
+            if key not in index["keys"]:
+                index["keys"].append(key)
+                index["vectors"] = embedding[np.newaxis, :] if index["vectors"] is None else np.vstack([index["vectors"], embedding])
+
+
+# --- Render Cache ---
+
+def _render_cache_key(manim_code: str) -> str:
+    """Hashes a script together with the render quality and frame rate it will be rendered at."""
+    return hashlib.sha256((manim_code + MANIM_QUALITY + str(MANIM_FPS)).encode("utf-8")).hexdigest()
+
+def lookup_cached_video(key: str) -> str | None:
+    """Returns the path of a previously rendered video for this key, counting the hit."""
+    cached_video_path = CACHE_DIR / f"{key}.mp4"
+    try:
+        os.utime(cached_video_path) # Marks it as recently used, which shields it from eviction
+    except OSError:
+        return None
+    with closing(_open_cache_db()) as conn, conn:
+        conn.execute(
+            "INSERT INTO render_cache (key, hits) VALUES (?, 1) "
+            "ON CONFLICT(key) DO UPDATE SET hits = hits + 1",
+            (key,),
+        )
+    return str(cached_video_path)
+
+def store_cached_video(key: str, video_path: Path) -> str:
+    """
+    Copies a freshly rendered video into the cache, evicting the least frequently used entries.
+    Returns the cached path, or the original path if the copy failed.
+    """
+    cached_video_path = CACHE_DIR / f"{key}.mp4"
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Copy under a temporary name and rename it into place, since lookups only check that the file exists
+        fd, tmp_name = tempfile.mkstemp(dir=CACHE_DIR, prefix=f"{key}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            shutil.copy(video_path, tmp_name)
+            os.replace(tmp_name, cached_video_path)
+        except OSError:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+    except OSError:
+        return str(video_path)
+
+    with closing(_open_cache_db()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO render_cache (key, hits) VALUES (?, 0)", (key,))
+        excess = conn.execute("SELECT COUNT(*) FROM render_cache").fetchone()[0] - RENDER_CACHE_MAX_ENTRIES
+        candidates = conn.execute(
+            "SELECT key FROM render_cache WHERE key != ? ORDER BY hits ASC", (key,)
+        ).fetchall() if excess > 0 else []
+        for (evicted_key,) in candidates:
+            if excess <= 0:
+                break
+            evicted_path = CACHE_DIR / f"{evicted_key}.mp4"
+            try:
+                if time.time() - evicted_path.stat().st_mtime < RENDER_CACHE_MIN_AGE_SECONDS:
+                    continue # Recently added or hit; the cache may run over its size until it ages
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM render_cache WHERE key = ?", (evicted_key,))
+            evicted_path.unlink(missing_ok=True)
+            excess -= 1
+    return str(cached_video_path)
+
+
 # --- Helper Functions (Original code - largely unchanged, minor subprocess improvement) ---
 
-def generate_manim_code_from_llm(user_query: str) -> str | None:
-    """Generates Manim code using the LLM."""
+@st.cache_resource
+def _get_event_loop() -> asyncio.AbstractEventLoop:
+    """Starts the long-lived event loop that all async LLM calls run on."""
+    # The SDK caches its grpc.aio client, which is bound to the loop it was created
+    # on, so a fresh asyncio.run() per call would break every call after the first.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="sketchmotion-asyncio", daemon=True).start()
+    return loop
+
+def _run_async(coro):
+    """Runs a coroutine on the shared event loop and blocks until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_event_loop()).result()
+
+async def agenerate_manim_code_from_llm(user_query: str, on_text: Callable[[str], None] | None = None) -> tuple[str, str]:
+    """
+    Generates Manim code using the LLM, streaming the response without blocking while waiting on it.
+    Returns (scene_name, manim_code); each streamed chunk of raw response text is passed to `on_text`.
+    Runs off the Streamlit script thread, so errors are raised for the caller to report.
+    """
+    model = _MODEL
+    prompt = LLM_PROMPT_TEMPLATE.format(user_prompt=user_query)
+    response = await model.generate_content_async(prompt, generation_config=GENERATION_CONFIG, stream=True)
+    async for chunk in response:
+        if on_text is not None and chunk.parts:
+            on_text(chunk.text)
+    await response.resolve()
+
+    if response.candidates and response.candidates[0].finish_reason.name == "MAX_TOKENS":
+        raise ValueError(f"the response was cut off at {GENERATION_CONFIG['max_output_tokens']} tokens; try a simpler animation")
+    generated = json.loads(response.text)
+    scene_name, manim_code = generated["scene_name"].strip(), generated["code"].strip()
+    if not scene_name.isidentifier() or not re.search(rf"class\s+{scene_name}\b", manim_code):
+        raise ValueError(f"the response names scene '{scene_name}', which the generated code does not define")
+    return scene_name, manim_code
+
+# The (possibly still unterminated) "code" string of a partial JSON response
+_PARTIAL_CODE_RE = re.compile(r'"code"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+def _partial_code_preview(partial_response: str) -> str | None:
+    """Decodes as much of the "code" field as has streamed in so far, or None if it hasn't started."""
+    match = _PARTIAL_CODE_RE.search(partial_response)
+    if not match:
+        return None
+    # Drop an escape sequence cut off mid-chunk, e.g. a trailing `\u00`
+    escaped = re.sub(r"\\u[0-9a-fA-F]{0,3}$", "", match.group(1))
     try:
-        model = genai.GenerativeModel(MODEL_NAME)
-        prompt = LLM_PROMPT_TEMPLATE.format(user_prompt=user_query)
-        response = model.generate_content(prompt)
-        
-        generated_text = response.text
-        if generated_text.strip().startswith("```python"):
-            generated_text = generated_text.strip()[9:] 
-        if generated_text.strip().endswith("```"):
-            generated_text = generated_text.strip()[:-3] 
-        
-        return generated_text.strip()
+        return json.loads(f'"{escaped}"')
+    except ValueError:
+        return None
+
+def generate_manim_code_from_llm(user_query: str, preview=None) -> tuple[str, str] | None:
+    """
+    Generates (scene_name, manim_code) using the LLM (single-prompt path),
+    serving repeat prompts from the cache. If `preview` (an `st.empty()` placeholder)
+    is given, the code is shown there as it streams in.
+    """
+    scene = lookup_cached_code(user_query)
+    if scene is not None:
+        return scene
+
+    # The LLM call runs on the event loop thread; chunks come back through a queue
+    # because only the script thread may update the UI.
+    chunks = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        agenerate_manim_code_from_llm(user_query, on_text=chunks.put if preview is not None else None),
+        _get_event_loop(),
+    )
+    streamed = ""
+    while not wait([future], timeout=0.1).done or not chunks.empty():
+        received = ""
+        while not chunks.empty():
+            received += chunks.get_nowait()
+        if received:
+            streamed += received
+            code_so_far = _partial_code_preview(streamed)
+            if code_so_far:
+                preview.code(code_so_far, language="python")
+
+    try:
+        scene = future.result()
     except Exception as e:
         st.error(f"Error calling LLM ({MODEL_NAME}): {e}")
         return None
 
-def extract_scene_name(manim_code: str) -> str | None:
-    """Extracts the Manim scene class name from the code."""
-    match = re.search(r"class\s+(\w+)\(Scene\):", manim_code)
-    if match:
-        return match.group(1)
-    st.error("Could not find Scene name in the generated code. The LLM might have provided an invalid Manim script.")
-    return None
+    store_cached_code(user_query, *scene)
+    return scene
+
+def generate_manim_code_batch(user_queries: list[str], quiet: bool = False) -> list[tuple[str, str] | None]:
+    """
+    Generates (scene_name, manim_code) for several prompts concurrently, serving repeat prompts from the cache.
+    Failed prompts map to None; `quiet` suppresses their error messages.
+    """
+    scenes = {query: lookup_cached_code(query) for query in user_queries}
+    misses = [query for query, scene in scenes.items() if scene is None]
+
+    async def _gather():
+        return await asyncio.gather(
+            *[agenerate_manim_code_from_llm(query) for query in misses],
+            return_exceptions=True,
+        )
+
+    for query, result in zip(misses, _run_async(_gather()) if misses else []):
+        if isinstance(result, Exception):
+            if not quiet:
+                st.error(f"Error calling LLM ({MODEL_NAME}): {result}")
+            continue
+        store_cached_code(query, *result)
+        scenes[query] = result
+    return [scenes[query] for query in user_queries]
+
+@st.cache_resource(show_spinner="Warming up the animation cache...")
+def seed_code_cache(prompts: tuple[str, ...]) -> None:
+    """Pre-generates code for the suggestion prompts once per server process."""
+    generate_manim_code_batch(list(prompts), quiet=True)
+
+_ANIMATION_CALL_RE = re.compile(r"self\.(?:play|wait)\(")
+_ANIMATION_DONE_RE = re.compile(rb"Animation (\d+)\s*:")
+
+async def _arun_manim_process(command: list[str], timeout: float, progress: dict) -> tuple[int, str, str]:
+    """
+    Runs the Manim CLI without blocking the event loop, keeping only the last lines of its output.
+    Completed animations are counted into progress["animations_done"] as Manim logs them.
+    Returns (returncode, stdout, stderr); raises subprocess.TimeoutExpired carrying the output on timeout.
+    """
+    # Added creationflags to hide console window on Windows for a cleaner UX
+    process_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, limit=1024 * 1024, creationflags=process_flags
+    )
+    stdout_lines = deque(maxlen=MANIM_OUTPUT_MAX_LINES)
+    stderr_lines = deque(maxlen=MANIM_OUTPUT_MAX_LINES)
+
+    async def _drain(stream: asyncio.StreamReader, lines: deque) -> None:
+        async for line in stream:
+            lines.append(line)
+            match = _ANIMATION_DONE_RE.search(line)
+            if match:
+                progress["animations_done"] = int(match.group(1)) + 1
+
+    def _decode(lines: deque) -> str:
+        # Only the kept tail is ever displayed; progress bars may not be valid UTF-8
+        return b"".join(lines).decode("utf-8", errors="replace")
+
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(_drain(process.stdout, stdout_lines), _drain(process.stderr, stderr_lines), process.wait()),
+            timeout,
+        )
+    except asyncio.TimeoutError:
+        # The readers were cancelled above, so report only what was already buffered
+        raise subprocess.TimeoutExpired(command, timeout, output=_decode(stdout_lines), stderr=_decode(stderr_lines))
+    finally:
+        # Timeout, a reader error (e.g. a line over the limit) or cancellation: never orphan the child
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), 2) # Bounded: don't hang on a child stuck in the kernel
+            except asyncio.TimeoutError:
+                pass
+    return process.returncode, _decode(stdout_lines), _decode(stderr_lines)
+
+def _run_manim_cli(command: list[str], manim_code: str, timeout: float) -> tuple[int, str, str]:
+    """Runs the Manim CLI on the shared event loop while showing render progress."""
+    progress = {"animations_done": 0}
+    total_animations = max(len(_ANIMATION_CALL_RE.findall(manim_code)), 1)
+    future = asyncio.run_coroutine_threadsafe(_arun_manim_process(command, timeout, progress), _get_event_loop())
+
+    progress_bar = st.progress(0.0)
+    while not wait([future], timeout=0.25).done:
+        progress_bar.progress(min(progress["animations_done"] / total_animations, 1.0))
+    progress_bar.empty()
+    return future.result()
+
+_TEX_RE = re.compile(r"\w*Tex\b")
+
+def _render_config(manim_code: str) -> dict:
+    """Manim config overrides for a render. OpenGL is only used for scenes that need no LaTeX."""
+    use_opengl = MANIM_USE_OPENGL and not _TEX_RE.search(manim_code)
+    return {"frame_rate": MANIM_FPS, "renderer": "opengl" if use_opengl else "cairo"}
+
+def _manim_command(tmp_script_path: Path, scene_name: str, render_config: dict) -> list[str]:
+    """Builds the Manim CLI command for the given render config."""
+    # Caching only pays off when re-rendering the same script, which the render cache already covers
+    command = ["manim", MANIM_QUALITY, "--disable_caching", "--flush_cache", "--fps", str(render_config["frame_rate"])]
+    if render_config["renderer"] == "opengl":
+        command.append("--renderer=opengl")
+    return command + [str(tmp_script_path), scene_name]
+
+@st.cache_resource(show_spinner="Starting the Manim render worker...")
+def get_render_worker() -> RenderWorkerPool:
+    """Starts the persistent render workers (Manim pre-imported) once per server process."""
+    worker = RenderWorkerPool(RENDER_WORKERS)
+    worker.start()
+    return worker
+
+def _manim_output_markdown(stdout: str | None, stderr: str | None, when: str = "", notes: list[str] | None = None) -> str:
+    """
+    Formats Manim's output (plus any diagnostic notes) as one Markdown block,
+    so a failure report is sent to the browser as a single element.
+    """
+    def fenced(text: str) -> str:
+        # Longer than any backtick run in the output, so the output can't close the fence early
+        fence = "`" * max([3] + [len(run) + 1 for run in re.findall(r"`+", text)])
+        return f"{fence}\n{text}\n{fence}"
+
+    sections = [
+        f"#### Manim Standard Output{when}:", fenced(stdout or "No standard output."),
+        f"#### Manim Standard Error{when}:", fenced(stderr or "No standard error."),
+        *(notes or []),
+    ]
+    return "\n\n".join(sections)
+
+def write_temp_script(manim_code: str) -> Path:
+    """Writes the code to a uniquely named temporary script, so its media dir never pre-exists."""
+    with tempfile.NamedTemporaryFile(mode="wb", suffix=".py", delete=False) as tmp_script:
+        tmp_script.write(manim_code.encode("utf-8"))
+    return Path(tmp_script.name)
+
+def _discard_script_media(tmp_script_path: Path) -> None:
+    """Deletes a finished render's media dir in the background; the video itself lives on in the render cache."""
+    temp_script_media_dir = Path("media") / "videos" / tmp_script_path.stem
+    threading.Thread(target=shutil.rmtree, args=(temp_script_media_dir,), kwargs={"ignore_errors": True}, daemon=True).start()
 
 def run_manim(manim_code: str, scene_name: str) -> str | None:
     """
     Runs Manim to render the animation.
     Returns the path to the rendered video file or None on failure.
     """
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".py", delete=False) as tmp_script:
-        tmp_script_path = tmp_script.name
-        tmp_script.write(manim_code)
-
-    script_path_obj = Path(tmp_script_path)
-    script_name_no_ext = script_path_obj.stem 
-
-    quality_folder_map = {
-        "-ql": "480p15",
-        "-qm": "720p30",
-        "-qh": "1080p60",
-        "-qk": "2160p60", 
+    cache_key = _render_cache_key(manim_code)
+    cached_video_path = lookup_cached_video(cache_key)
+    if cached_video_path:
+        return cached_video_path
+
+    tmp_script_path = write_temp_script(manim_code)
+    script_name_no_ext = tmp_script_path.stem 
+
+    quality_heights = {
+        "-ql": 480,
+        "-qm": 720,
+        "-qh": 1080,
+        "-qk": 2160, 
     }
-    quality_folder = quality_folder_map.get(MANIM_QUALITY, "720p30") 
+    quality_folder = f"{quality_heights.get(MANIM_QUALITY, 720)}p{MANIM_FPS}"
 
     media_dir = Path("media")
     video_output_dir = media_dir / "videos" / script_name_no_ext / quality_folder
     expected_video_path = video_output_dir / f"{scene_name}.mp4"
 
-    if media_dir.exists():
-        temp_script_media_dir = media_dir / "videos" / script_name_no_ext
-        if temp_script_media_dir.exists():
-            try:
-                shutil.rmtree(temp_script_media_dir)
-            except Exception as e:
-                st.warning(f"Could not clean up old media for {script_name_no_ext}: {e}")
-        
-    command = ["manim", MANIM_QUALITY, tmp_script_path, scene_name]
+    render_config = _render_config(manim_code)
+    command = _manim_command(tmp_script_path, scene_name, render_config)
     
-    process = None # Initialize process to None
+    video_file_path = None
     try:
-        # Added creationflags to hide console window on Windows for a cleaner UX
-        process_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, creationflags=process_flags)
-        stdout, stderr = process.communicate(timeout=120) 
+        worker = get_render_worker()
+        if worker.error is None:
+            result = worker.render(tmp_script_path, scene_name, MANIM_QUALITY, media_dir, timeout=120, config=render_config)
+            returncode = 1 if "error" in result else 0
+            stdout, stderr = result["output"], result.get("error", "")
+            if "video_path" in result:
+                expected_video_path = Path(result["video_path"])
+        else:
+            # Manim isn't importable from this interpreter (e.g. installed as a standalone CLI)
+            returncode, stdout, stderr = _run_manim_cli(command, manim_code, timeout=120)
 
-        if process.returncode != 0:
-            st.error(f"Manim execution failed! (Return code: {process.returncode})")
+        if returncode != 0:
+            st.error(f"Manim execution failed! (Return code: {returncode})")
             with st.expander("Manim Output Details"):
-                st.subheader("Manim Standard Output:")
-                st.code(stdout if stdout else "No standard output.", language=None)
-                st.subheader("Manim Standard Error:")
-                st.code(stderr if stderr else "No standard error.", language=None)
+                st.markdown(_manim_output_markdown(stdout, stderr))
             return None
         
         if expected_video_path.exists():
-            return str(expected_video_path)
+            video_file_path = store_cached_video(cache_key, expected_video_path)
+            return video_file_path
         else:
             st.error(f"Manim seemed to succeed, but the video file was not found at: {expected_video_path}")
+            possible_parent = media_dir / "videos" / script_name_no_ext
+            if possible_parent.exists():
+                notes = [f"Contents of `{possible_parent}`: `{[e.name for e in os.scandir(possible_parent) if e.is_dir()]}`"]
+                if (possible_parent / quality_folder).exists():
+                    notes.append(f"Contents of `{possible_parent / quality_folder}`: `{[e.name for e in os.scandir(possible_parent / quality_folder)]}`")
+            else:
+                notes = [f"Media directory for script (`{possible_parent}`) does not exist."]
             with st.expander("Manim Output & File System Details (Video Not Found)"):
-                st.info(f"Manim STDOUT:\n{stdout if stdout else 'No standard output.'}")
-                st.info(f"Manim STDERR:\n{stderr if stderr else 'No standard error.'}")
-                possible_parent = media_dir / "videos" / script_name_no_ext
-                if possible_parent.exists():
-                    st.info(f"Contents of {possible_parent}: {list(p.name for p in possible_parent.iterdir() if p.is_dir())}")
-                    if (possible_parent / quality_folder).exists():
-                         st.info(f"Contents of {possible_parent / quality_folder}: {list(p.name for p in (possible_parent / quality_folder).iterdir())}")
-                else:
-                    st.info(f"Media directory for script ({possible_parent}) does not exist.")
+                st.markdown(_manim_output_markdown(stdout, stderr, notes=notes))
             return None
 
-    except subprocess.TimeoutExpired:
+    except subprocess.TimeoutExpired as e:
         st.error("Manim rendering timed out after 120 seconds. The animation might be too complex or long.")
-        if process: # Ensure process is not None
-            process.kill()
-            stdout, stderr = process.communicate()
-            with st.expander("Manim Output Details (Timeout)"):
-                st.subheader("Manim Standard Output (on timeout):")
-                st.code(stdout if stdout else "No standard output.", language=None)
-                st.subheader("Manim Standard Error (on timeout):")
-                st.code(stderr if stderr else "No standard error.", language=None)
+        with st.expander("Manim Output Details (Timeout)"):
+            st.markdown(_manim_output_markdown(e.output, e.stderr, when=" (on timeout)"))
         return None
     except FileNotFoundError:
         st.error("Manim command not found. Please ensure Manim is installed and added to your system's PATH.")
@@ -187,6 +586,52 @@ def run_manim(manim_code: str, scene_name: str) -> str | None:
                  os.remove(tmp_script_path)
         except OSError:
             pass # st.warning(f"Could not remove temporary script {tmp_script_path}")
+        if video_file_path is None or Path(video_file_path).is_relative_to(CACHE_DIR):
+            _discard_script_media(tmp_script_path) # Kept only if caching the video failed
+
+def _prewarm_render(scene_name: str, manim_code: str) -> None:
+    """Renders one script straight into the render cache. Runs off the script thread, so it never touches the UI."""
+    cache_key = _render_cache_key(manim_code)
+    if (CACHE_DIR / f"{cache_key}.mp4").exists():
+        return
+
+    tmp_script_path = write_temp_script(manim_code)
+    worker = RenderWorker() # One worker process per job so renders use separate cores
+    try:
+        result = worker.render(
+            tmp_script_path, scene_name, MANIM_QUALITY, Path("media"), timeout=120, config=_render_config(manim_code)
+        )
+        if "video_path" in result:
+            store_cached_video(cache_key, Path(result["video_path"]))
+    except subprocess.TimeoutExpired:
+        pass
+    finally:
+        worker.stop()
+        tmp_script_path.unlink(missing_ok=True)
+        _discard_script_media(tmp_script_path)
+
+@st.cache_resource
+def prewarm_suggestions(prompts: tuple[str, ...]) -> ThreadPoolExecutor | None:
+    """Renders the cached code for the suggestion prompts in parallel, in the background, once per server process."""
+    if get_render_worker().error is not None:
+        return None # No in-process Manim, so no workers to render with
+    scenes = [scene for scene in map(lookup_cached_code, prompts) if scene]
+    if not scenes:
+        return None
+
+    executor = ThreadPoolExecutor(max_workers=min(len(scenes), os.cpu_count() or 1), thread_name_prefix="sketchmotion-prewarm")
+    for scene_name, manim_code in scenes:
+        executor.submit(_prewarm_render, scene_name, manim_code)
+    executor.shutdown(wait=False)
+    return executor
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def _read_video(path: str, mtime: float) -> bytes:
+    """
+    Reads a rendered video once per (path, mtime). Given a path, st.video reads the whole file again
+    on every script rerun; cache_resource hands back the same bytes object rather than a copy.
+    """
+    return Path(path).read_bytes()
 
 
 # --- Streamlit UI ---
@@ -207,6 +652,9 @@ suggestions = {
         "Square to Circle": "A square transforms into a circle.",
         "Growing Line": "Animate a line growing from left to right from the center.",
     }
+get_render_worker()
+seed_code_cache(tuple(suggestions.values()))
+prewarm_suggestions(tuple(suggestions.values()))
 num_suggestion_cols = min(len(suggestions), 4)
 suggestion_cols = st.columns(num_suggestion_cols)
 suggestion_items = list(suggestions.items())
@@ -246,24 +694,24 @@ if submitted_form:
         st.session_state.last_user_prompt = user_prompt_to_process
         st.session_state.video_path = None # Clear previous video
 
+        code_preview = st.empty()
         with st.spinner("Crafting Animation Visuals..."):
-            manim_code = generate_manim_code_from_llm(user_prompt_to_process)
+            scene = generate_manim_code_from_llm(user_prompt_to_process, preview=code_preview)
+        code_preview.empty()
 
-        if manim_code:
+        if scene:
+            scene_name, manim_code = scene
             # For debugging:
             # with st.expander("Generated Manim Code (Debug View)"):
             #    st.code(manim_code, language="python")
 
-            scene_name = extract_scene_name(manim_code)
-            if scene_name:
-                with st.spinner(f"Rendering '{scene_name}' with Manim... 🎞️ (can take a moment)"):
-                    video_file_path = run_manim(manim_code, scene_name)
+            with st.spinner(f"Rendering '{scene_name}' with Manim... 🎞️ (can take a moment)"):
+                video_file_path = run_manim(manim_code, scene_name)
 
-                if video_file_path:
-                    st.session_state.video_path = video_file_path
-                # Error messages for failed generation are handled within run_manim
-            # Error messages for scene name extraction are handled within extract_scene_name
-        # Error messages for LLM call are handled within generate_manim_code_from_llm
+            if video_file_path:
+                st.session_state.video_path = video_file_path
+            # Error messages for failed generation are handled within run_manim
+        # Error messages for LLM call (and invalid responses) are handled within generate_manim_code_from_llm
     else:
         st.warning("Empty prompt! Please type a description or click a suggestion, then hit 'Generate!'. 🤔")
 
@@ -271,9 +719,8 @@ if submitted_form:
 if st.session_state.video_path:
     st.subheader(f"Your Animation: '{st.session_state.last_user_prompt}'")
     try:
-        with open(st.session_state.video_path, 'rb') as video_file:
-            video_bytes = video_file.read()
-        st.video(video_bytes)
+        video_path = st.session_state.video_path
+        st.video(_read_video(video_path, os.path.getmtime(video_path))) # getmtime raises FileNotFoundError
 
         if st.button("🔄 Create Another Animation", help="Clear current animation and prompt"):
             # Clean up the displayed video file if it exists and is from our temp storage
@@ -289,6 +736,17 @@ if st.session_state.video_path:
             st.rerun()
 
     except FileNotFoundError:
+        # An older cached video may have been evicted since; render it again if its code is still cached
+        in_render_cache = Path(st.session_state.video_path).parent == CACHE_DIR
+        scene = lookup_cached_code(st.session_state.last_user_prompt) if in_render_cache else None
+        video_file_path = None
+        if scene:
+            scene_name, manim_code = scene
+            with st.spinner(f"Rendering '{scene_name}' again with Manim... 🎞️"):
+                video_file_path = run_manim(manim_code, scene_name)
+        if video_file_path and os.path.exists(video_file_path):
+            st.session_state.video_path = video_file_path
+            st.rerun()
         st.error(f"Critical Error: Video file not found at '{st.session_state.video_path}'. This might indicate an issue with file paths or cleanup processes. Please check Manim output if available from a previous step.")
     except Exception as e:
         st.error(f"An error occurred while trying to display the video: {e}")
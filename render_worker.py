@@ -0,0 +1,417 @@
+"""
+Long-lived Manim render worker.
+
+Running `python render_worker.py` imports Manim once and then renders jobs sent as
+JSON lines on stdin, answering each with one JSON line on stdout. This skips the
+interpreter startup and Manim import that every `manim` CLI call pays.
+
+`RenderWorker` manages one such process on behalf of the Streamlit app, and
+`RenderWorkerPool` keeps several so concurrent sessions don't wait on each other.
+"""
+import contextlib
+import inspect
+import io
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+from collections import deque
+from pathlib import Path
+
+# Manim CLI quality flags and the config presets they correspond to
+QUALITY_PRESETS = {
+    "-ql": "low_quality",
+    "-qm": "medium_quality",
+    "-qh": "high_quality",
+    "-qk": "fourk_quality",
+}
+OUTPUT_MAX_LINES = 500 # Lines of render output kept per job, as on the app's CLI path
+
+
+# --- Worker Process ---
+
+# SceneFileWriter hooks overridden below: how many leading positional parameters each takes
+# (the frame, allow_write) and the optional extras it may also take. These have moved between
+# Manim releases (write_frame's second parameter was num_frames, now keyword-only repeat), so
+# the check goes by position and kind for the leading ones and by name only for the known extras.
+_PIPED_WRITER_HOOKS = {
+    "begin_animation": (1, {"file_path", "animation_index"}),
+    "end_animation": (1, set()),
+    "write_frame": (1, {"num_frames", "repeat"}),
+    "finish": (0, set()),
+}
+_POSITIONAL_KINDS = (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+
+def _piped_writer_fits(manim) -> bool:
+    """Checks that this Manim's SceneFileWriter hooks still take the parameters the piped writer handles."""
+    for name, (positional_count, known_extras) in _PIPED_WRITER_HOOKS.items():
+        hook = getattr(manim.SceneFileWriter, name, None)
+        if hook is None:
+            return False
+        try:
+            parameters = list(inspect.signature(hook).parameters.values())[1:] # Drop self
+        except (TypeError, ValueError):
+            return False
+        leading, extras = parameters[:positional_count], parameters[positional_count:]
+        if len(leading) < positional_count or any(p.kind not in _POSITIONAL_KINDS for p in leading):
+            return False
+        if any(p.name not in known_extras for p in extras):
+            return False
+    return True
+
+class _StockWriterNeeded(Exception):
+    """Raised by the piped writer when the scene turned out to need the stock writer (e.g. it added sound)."""
+
+def _piped_file_writer_class(manim, ffmpeg: str) -> type:
+    """
+    Builds a SceneFileWriter that streams every frame of the scene into one ffmpeg process.
+    Manim otherwise encodes a partial movie per animation and concatenates them at the end,
+    which costs more than the frames themselves for clips this short.
+    Output the pipe can't produce (other formats, transparency, sections) goes through the stock writer.
+    """
+    class PipedSceneFileWriter(manim.SceneFileWriter):
+        piped = None # Decided at the first animation, once the output paths are known
+        writing = False
+        ffmpeg_process = None
+        ffmpeg_log = None
+
+        def _pipe_fits_output(self) -> bool:
+            config = manim.config
+            try:
+                movie_file_path = Path(self.movie_file_path)
+            except AttributeError: # Not writing a video at all
+                return False
+            # Older Manim releases have write_to_movie; newer ones fold it into format
+            return (
+                getattr(config, "write_to_movie", True) and movie_file_path.suffix == ".mp4"
+                and config.format in (None, "auto", "mp4") and not config.transparent and not config.save_sections
+            )
+
+        def begin_animation(self, allow_write=False, *args, **kwargs):
+            if self.piped is None:
+                self.piped = self._pipe_fits_output()
+            if not self.piped:
+                return super().begin_animation(allow_write, *args, **kwargs)
+            self.writing = allow_write
+
+        def end_animation(self, allow_write=False, *args, **kwargs):
+            if not self.piped:
+                return super().end_animation(allow_write, *args, **kwargs)
+            self.writing = False # The pipe itself stays open across animations
+
+        def write_frame(self, frame, *args, **kwargs):
+            if not self.piped:
+                return super().write_frame(frame, *args, **kwargs)
+            if not self.writing:
+                return
+            if hasattr(frame, "get_frame"): # Older OpenGL renderers pass themselves rather than the pixels
+                frame = frame.get_frame()
+            if self.ffmpeg_process is None:
+                self._start_ffmpeg(width=frame.shape[1], height=frame.shape[0])
+            frame_bytes = frame.tobytes()
+            try:
+                # The frame count is positional num_frames in older releases, keyword-only repeat in newer ones
+                for _ in range(kwargs.get("repeat", args[0] if args else kwargs.get("num_frames", 1))):
+                    self.ffmpeg_process.stdin.write(frame_bytes)
+            except BrokenPipeError:
+                self.ffmpeg_process.wait()
+                raise self._encoder_error() from None
+
+        def finish(self, *args, **kwargs):
+            if not self.piped:
+                return super().finish(*args, **kwargs)
+            if self.ffmpeg_process is None:
+                return
+            if self.includes_sound:
+                # Muxing the audio track is the stock writer's job; the caller renders again with it
+                self.ffmpeg_process.kill()
+                raise _StockWriterNeeded("the scene adds sound")
+            self.ffmpeg_process.stdin.close()
+            if self.ffmpeg_process.wait() != 0:
+                raise self._encoder_error()
+            # Surface encoder warnings in the job output rather than dropping them
+            self.ffmpeg_log.seek(0)
+            sys.stderr.write(self.ffmpeg_log.read().decode("utf-8", errors="replace"))
+            if self.subcaptions:
+                self.write_subcaption_file()
+            self.print_file_ready_message(self.movie_file_path)
+
+        def _start_ffmpeg(self, width: int, height: int) -> None:
+            Path(self.movie_file_path).parent.mkdir(parents=True, exist_ok=True)
+            command = [
+                ffmpeg, "-y", "-loglevel", "error",
+                "-f", "rawvideo", "-pix_fmt", "rgba",
+                "-s", f"{width}x{height}",
+                "-r", str(manim.config.frame_rate),
+                "-i", "-",
+                "-an", "-c:v", "libx264", "-pix_fmt", "yuv420p",
+                str(self.movie_file_path),
+            ]
+            # A file rather than a pipe, so a chatty encoder can never block on an unread stderr
+            self.ffmpeg_log = tempfile.TemporaryFile()
+            self.ffmpeg_process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.ffmpeg_log
+            )
+
+        def _encoder_error(self) -> RuntimeError:
+            """Builds the error for a failed encode, including what ffmpeg printed."""
+            self.ffmpeg_log.seek(0)
+            message = self.ffmpeg_log.read().decode("utf-8", errors="replace").strip()
+            return RuntimeError(
+                f"ffmpeg exited with code {self.ffmpeg_process.returncode} while encoding {self.movie_file_path}"
+                + (f":\n{message}" if message else "")
+            )
+
+    return PipedSceneFileWriter
+
+def _make_renderer(manim, file_writer_class: type):
+    """Creates the renderer selected by the current config, writing through `file_writer_class`."""
+    if manim.config.renderer == manim.RendererType.OPENGL:
+        from manim.renderer.opengl_renderer import OpenGLRenderer
+        return OpenGLRenderer(file_writer_class=file_writer_class)
+    from manim.renderer.cairo_renderer import CairoRenderer
+    return CairoRenderer(file_writer_class=file_writer_class)
+
+def _render_scene(manim, scene_class: type, file_writer_class: type) -> str:
+    """Renders `scene_class` under the current config and returns the path of the resulting video."""
+    scene = scene_class(renderer=_make_renderer(manim, file_writer_class))
+    try:
+        scene.render()
+    finally:
+        # Don't leave an encoder running if the scene raised mid-render
+        ffmpeg_process = getattr(scene.renderer.file_writer, "ffmpeg_process", None)
+        if ffmpeg_process is not None and ffmpeg_process.poll() is None:
+            ffmpeg_process.kill()
+    return str(scene.renderer.file_writer.movie_file_path)
+
+def _render_job(manim, file_writer_class: type, job: dict) -> str:
+    """Renders one scene and returns the path of the resulting video."""
+    script_path = job["script_path"]
+
+    # Match the CLI's output layout: <media_dir>/videos/<script stem>/<quality folder>/<scene>.mp4
+    with manim.tempconfig({
+        "input_file": script_path,
+        "media_dir": job["media_dir"],
+        "quality": QUALITY_PRESETS.get(job["quality"], "medium_quality"),
+        # Cached partial movie files are never written when frames go straight to ffmpeg
+        "disable_caching": True,
+        **job["config"], # After "quality", which would otherwise reset e.g. frame_rate
+    }):
+        # Run the script inside tempconfig so module-level config writes are undone with it
+        namespace = {"__name__": Path(script_path).stem, "__file__": script_path}
+        with open(script_path, encoding="utf-8") as script:
+            exec(compile(script.read(), script_path, "exec"), namespace)
+        scene_class = namespace[job["scene_name"]]
+        try:
+            return _render_scene(manim, scene_class, file_writer_class)
+        except _StockWriterNeeded as e:
+            print(f"Rendering again with Manim's own file writer: {e}.")
+            return _render_scene(manim, scene_class, manim.SceneFileWriter)
+
+class _OutputTail(io.TextIOBase):
+    """Text stream that keeps only the last `max_lines` lines written to it."""
+
+    def __init__(self, max_lines: int):
+        self._lines = deque(maxlen=max_lines)
+        self._partial = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        # Progress bars redraw with "\r", so that counts as a line break here too
+        lines = (self._partial + text).splitlines(keepends=True)
+        self._partial = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        self._partial = self._partial[-10_000:] # Bound a line that never ends
+        self._lines.extend(lines)
+        return len(text)
+
+    def getvalue(self) -> str:
+        return "".join(self._lines) + self._partial
+
+def main() -> None:
+    # Reply on a private copy of fd 1 and point fd 1 itself at stderr. The scripts are generated,
+    # and anything they start (os.system, subprocesses, C extensions) writes to fd 1 directly.
+    protocol = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr # Keep stray prints off the protocol channel
+
+    def reply(message: dict) -> None:
+        protocol.write(json.dumps(message) + "\n")
+        protocol.flush()
+
+    try:
+        import manim
+    except ImportError as e:
+        reply({"ready": False, "error": str(e)})
+        return
+    ffmpeg = shutil.which("ffmpeg")
+    # Stock writer if there is no ffmpeg binary or this Manim's writer hooks don't match the override
+    use_piped_writer = ffmpeg is not None and _piped_writer_fits(manim)
+    file_writer_class = _piped_file_writer_class(manim, ffmpeg) if use_piped_writer else manim.SceneFileWriter
+    reply({"ready": True})
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        result = {}
+        output = _OutputTail(OUTPUT_MAX_LINES)
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                result["video_path"] = _render_job(manim, file_writer_class, job)
+            except Exception:
+                result["error"] = traceback.format_exc()
+        result["output"] = output.getvalue()
+        reply(result)
+
+
+# --- Client ---
+
+def _pump_lines(stream, lines: queue.Queue) -> None:
+    """Forwards lines from the worker's stdout so reads can time out. Puts None at EOF."""
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+class RenderWorker:
+    """Keeps one render worker process alive and sends it one job at a time."""
+
+    def __init__(self, startup_timeout: float = 60):
+        self.startup_timeout = startup_timeout
+        self.error = None
+        self._lock = threading.Lock()
+        self._process = None
+        self._lines = None
+
+    def start(self) -> bool:
+        """Starts the worker if it is not running. Returns False (and sets `error`) if it cannot start."""
+        if self._process is not None and self._process.poll() is None:
+            return True
+
+        # Hide console window on Windows for a cleaner UX
+        process_flags = subprocess.CREATE_NO_WINDOW if os.name == 'nt' else 0
+        try:
+            self._process = subprocess.Popen(
+                [sys.executable, str(Path(__file__).resolve())],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding="utf-8",
+                creationflags=process_flags,
+            )
+        except OSError as e:
+            self.error = str(e)
+            self._process = None
+            return False
+        self._lines = queue.Queue()
+        threading.Thread(target=_pump_lines, args=(self._process.stdout, self._lines), daemon=True).start()
+
+        try:
+            line = self._lines.get(timeout=self.startup_timeout)
+        except queue.Empty:
+            line = None
+        try:
+            status = json.loads(line) if line else {"ready": False, "error": "Render worker did not start."}
+        except json.JSONDecodeError:
+            status = {"ready": False, "error": f"Render worker sent an unexpected line: {line[:200]!r}"}
+        if not status["ready"]:
+            self.error = status["error"]
+            self.stop()
+            return False
+        self.error = None
+        return True
+
+    def stop(self) -> None:
+        """Kills the worker process; the next render starts a fresh one."""
+        if self._process is not None:
+            self._process.kill()
+            try:
+                self._process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                pass # Leave it to the OS rather than stall the caller
+            self._process = None
+
+    def render(self, script_path: Path, scene_name: str, quality: str, media_dir: Path, timeout: float,
+               config: dict | None = None, blocking: bool = True) -> dict | None:
+        """
+        Renders a scene and returns {"video_path": ..., "output": ...} or {"error": ..., "output": ...}.
+        `config` holds extra Manim config values (e.g. frame_rate) applied for this render only.
+        With `blocking=False`, returns None straight away if the worker is busy with another job.
+        Raises subprocess.TimeoutExpired (after killing the worker) if the render takes too long.
+        """
+        job = {
+            "script_path": str(script_path), "scene_name": scene_name, "quality": quality,
+            "media_dir": str(media_dir), "config": config or {},
+        }
+        if not self._lock.acquire(blocking=blocking):
+            return None
+        try:
+            if not self.start():
+                return {"error": f"Render worker unavailable: {self.error}", "output": ""}
+            try:
+                self._process.stdin.write(json.dumps(job) + "\n")
+                self._process.stdin.flush()
+                line = self._lines.get(timeout=timeout)
+            except queue.Empty:
+                self.stop()
+                raise subprocess.TimeoutExpired(["render_worker", scene_name], timeout)
+            except OSError:
+                line = None
+            if line is None:
+                self.stop()
+                return {"error": "Render worker exited unexpectedly.", "output": ""}
+            try:
+                return json.loads(line)
+            except json.JSONDecodeError:
+                # The real reply may still be queued; a fresh worker keeps it from answering the next job
+                self.stop()
+                return {"error": f"Render worker sent an unexpected line: {line[:200]!r}", "output": ""}
+        finally:
+            self._lock.release()
+
+class RenderWorkerPool:
+    """
+    Keeps up to `size` render workers alive. A render goes to the first idle worker; if all are
+    busy it gets a fresh worker instead of queueing, which joins the pool afterwards if there is room.
+    """
+
+    def __init__(self, size: int, startup_timeout: float = 60):
+        self.size = size
+        self.startup_timeout = startup_timeout
+        self._lock = threading.Lock()
+        self._workers = [RenderWorker(startup_timeout)]
+
+    @property
+    def error(self) -> str | None:
+        """Why the first worker could not start, or None if it is running."""
+        return self._workers[0].error
+
+    def start(self) -> bool:
+        """Starts the first worker. Returns False (and sets `error`) if it cannot start."""
+        return self._workers[0].start()
+
+    def render(self, script_path: Path, scene_name: str, quality: str, media_dir: Path, timeout: float,
+               config: dict | None = None) -> dict:
+        """Renders a scene on an idle worker; same results and exceptions as `RenderWorker.render`."""
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            result = worker.render(script_path, scene_name, quality, media_dir, timeout, config, blocking=False)
+            if result is not None:
+                return result
+
+        worker = RenderWorker(self.startup_timeout)
+        try:
+            return worker.render(script_path, scene_name, quality, media_dir, timeout, config)
+        finally:
+            with self._lock:
+                keep = len(self._workers) < self.size
+                if keep:
+                    self._workers.append(worker)
+            if not keep:
+                worker.stop()
+
+
+if __name__ == "__main__":
+    main()